@@ -15,14 +15,40 @@ import threading
 import time
 import uuid
 import re
+import hashlib
+import hmac
+import ipaddress
+import math
+from collections import deque
 from urllib.parse import urlparse, parse_qs
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-here')
+# 部署在代理後方（如 Cloud Run）時設定信任的代理層數，以從 X-Forwarded-For 取得真實的客戶端 IP
+# 沒有代理時必須維持 0，否則客戶端可偽造標頭繞過每個客戶端的限制
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
 
 # 全域變數來追蹤下載狀態
 download_status = {}
 
+# 下載排程與頻寬限制設定
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 4))
+PER_CLIENT_MAX_CONCURRENT = int(os.environ.get('PER_CLIENT_MAX_CONCURRENT', 2))
+PER_CLIENT_MAX_QUEUED = int(os.environ.get('PER_CLIENT_MAX_QUEUED', 5))
+# 每個客戶端的傳輸速率（bytes/秒），0 表示不限制
+EGRESS_RATE_PER_CLIENT = int(os.environ.get('EGRESS_RATE_PER_CLIENT', 2 * 1024 * 1024))
+# 所有客戶端合計的傳輸速率（bytes/秒），0 表示不限制
+EGRESS_RATE_TOTAL = int(os.environ.get('EGRESS_RATE_TOTAL', 0))
+EGRESS_CHUNK_SIZE = 64 * 1024
+# 同時進行的檔案傳輸上限，每個傳輸會佔用一個 gunicorn 執行緒，需小於執行緒數以保留給其他請求
+MAX_CONCURRENT_TRANSFERS = int(os.environ.get('MAX_CONCURRENT_TRANSFERS', 2))
+PER_CLIENT_MAX_TRANSFERS = int(os.environ.get('PER_CLIENT_MAX_TRANSFERS', 1))
+# 客戶端閒置超過此秒數後移除其排程狀態與統計，避免記憶體無限成長
+CLIENT_IDLE_TTL = int(os.environ.get('CLIENT_IDLE_TTL', 600))
+
 def is_valid_youtube_url(url):
     """驗證是否為有效的YouTube網址"""
     if not url or not isinstance(url, str):
@@ -64,6 +90,312 @@ def extract_video_id(url):
     
     return None
 
+def parse_api_keys(value):
+    """解析 CLIENT_API_KEYS 設定，格式為 "key1=權重,key2=權重"，未指定權重時為 1"""
+    api_keys = {}
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        key, _, weight = item.partition('=')
+        try:
+            weight = float(weight) if weight else 1.0
+        except ValueError:
+            weight = 1.0
+        # nan 或 inf 會破壞虛擬時間的比較，視為預設權重
+        api_keys[key.strip()] = max(weight, 0.1) if math.isfinite(weight) else 1.0
+    return api_keys
+
+CLIENT_API_KEYS = parse_api_keys(os.environ.get('CLIENT_API_KEYS', ''))
+
+# 查詢 /usage 所需的管理金鑰，未設定時停用該端點
+USAGE_ADMIN_KEY = os.environ.get('USAGE_ADMIN_KEY', '')
+# 僅在本行程內有效的雜湊鹽值，客戶端識別碼不會暴露原始金鑰或 IP
+CLIENT_ID_SALT = os.urandom(16)
+
+def _anonymize(value):
+    """將金鑰或 IP 轉為無法還原的短識別碼"""
+    return hmac.new(CLIENT_ID_SALT, value.encode('utf-8'), hashlib.sha256).hexdigest()[:12]
+
+def _client_address(address):
+    """IPv6 以 /64 網段為單位識別，避免輪換位址取得新的配額"""
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return address or 'unknown'
+    if ip.version == 6:
+        if ip.ipv4_mapped:
+            return str(ip.ipv4_mapped)
+        return str(ipaddress.ip_network(f'{ip}/64', strict=False))
+    return str(ip)
+
+def identify_client():
+    """
+    識別目前請求的客戶端，回傳 (client_id, weight)
+    已登記的 API 金鑰優先，否則以來源 IP 識別
+    """
+    api_key = request.headers.get('X-API-Key', '').strip()
+    if api_key and api_key in CLIENT_API_KEYS:
+        return f'key:{_anonymize(api_key)}', CLIENT_API_KEYS[api_key]
+    return f'ip:{_anonymize(_client_address(request.remote_addr))}', 1.0
+
+class TokenBucket:
+    """執行緒安全的 token bucket，用於限制傳輸速率"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def consume(self, amount):
+        """取得指定數量的 token，不足時阻塞等待"""
+        while amount > 0:
+            # 單次請求不超過桶容量，否則永遠無法滿足
+            portion = min(amount, self.capacity)
+            with self.lock:
+                self._refill()
+                if self.tokens >= portion:
+                    self.tokens -= portion
+                    amount -= portion
+                    continue
+                wait = (portion - self.tokens) / self.rate
+            time.sleep(wait)
+
+class _ClientQueue:
+    """單一客戶端的排程狀態與使用量統計"""
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.virtual_time = 0.0
+        self.pending = deque()
+        self.active = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.last_active = time.monotonic()
+
+class FairShareScheduler:
+    """
+    依客戶端加權公平分配下載名額
+    每個客戶端有並行與排隊上限，名額釋出時挑選虛擬時間最小（即依權重計算最少使用）的客戶端
+    """
+
+    def __init__(self, max_concurrent, per_client_concurrent, per_client_queued, idle_ttl=CLIENT_IDLE_TTL):
+        self.max_concurrent = max_concurrent
+        self.per_client_concurrent = per_client_concurrent
+        self.per_client_queued = per_client_queued
+        self.idle_ttl = idle_ttl
+        self.clients = {}
+        # 排隊中的工作對應的客戶端，工作開始執行後即移除
+        self.jobs = {}
+        self.active = 0
+        self.virtual_time = 0.0
+        self.lock = threading.Lock()
+
+    def submit(self, client_id, weight, job_id, func):
+        """加入下載工作，超過排隊上限時回傳 False"""
+        with self.lock:
+            self._evict_idle()
+            client = self.clients.get(client_id)
+            if client is None:
+                client = self.clients[client_id] = _ClientQueue(weight)
+            client.weight = weight
+            client.last_active = time.monotonic()
+            if len(client.pending) >= self.per_client_queued:
+                client.rejected += 1
+                return False
+            if not client.pending and not client.active:
+                # 閒置後重新加入的客戶端不能累積先前未使用的份額
+                client.virtual_time = max(client.virtual_time, self.virtual_time)
+            client.pending.append((job_id, func))
+            self.jobs[job_id] = client_id
+            client.submitted += 1
+            self._dispatch()
+        return True
+
+    def client_queue_position(self, job_id):
+        """
+        回傳工作在其所屬客戶端佇列中的位置（從 1 開始），不在佇列中時回傳 None
+        各客戶端依權重輪流取得名額，因此這不是全域的排隊順序
+        """
+        with self.lock:
+            client = self.clients.get(self.jobs.get(job_id))
+            if client:
+                for index, (pending_id, _) in enumerate(client.pending):
+                    if pending_id == job_id:
+                        return index + 1
+        return None
+
+    def _evict_idle(self):
+        # 呼叫前必須持有 self.lock
+        now = time.monotonic()
+        for client_id, client in list(self.clients.items()):
+            if not client.pending and not client.active and now - client.last_active > self.idle_ttl:
+                del self.clients[client_id]
+
+    def _dispatch(self):
+        # 呼叫前必須持有 self.lock
+        while self.active < self.max_concurrent:
+            eligible = [
+                (client.virtual_time, client_id, client)
+                for client_id, client in self.clients.items()
+                if client.pending and client.active < self.per_client_concurrent
+            ]
+            if not eligible:
+                return
+            virtual_time, client_id, client = min(eligible, key=lambda item: (item[0], item[1]))
+            job_id, func = client.pending.popleft()
+            self.jobs.pop(job_id, None)
+            self.virtual_time = virtual_time
+            client.virtual_time = virtual_time + 1.0 / client.weight
+            client.active += 1
+            self.active += 1
+            thread = threading.Thread(target=self._run, args=(client, func))
+            thread.daemon = True
+            thread.start()
+
+    def _run(self, client, func):
+        try:
+            func()
+        finally:
+            with self.lock:
+                client.active -= 1
+                client.completed += 1
+                client.last_active = time.monotonic()
+                self.active -= 1
+                self._dispatch()
+
+    def snapshot(self):
+        """回傳各客戶端的排程統計"""
+        with self.lock:
+            return {
+                client_id: {
+                    'weight': client.weight,
+                    'active': client.active,
+                    'queued': len(client.pending),
+                    'submitted': client.submitted,
+                    'completed': client.completed,
+                    'rejected': client.rejected
+                }
+                for client_id, client in self.clients.items()
+            }
+
+class _ShapedTransfer:
+    """
+    限速的回應內容，close() 時釋放傳輸名額並關閉原始檔案
+    即使回應從未被迭代（例如 HEAD 請求或客戶端提早斷線）也會由 WSGI 伺服器呼叫 close()
+    """
+
+    def __init__(self, shaper, client_id, chunks, bucket):
+        self.shaper = shaper
+        self.client_id = client_id
+        self.chunks = chunks
+        self.bucket = bucket
+        self.closed = False
+
+    def __iter__(self):
+        chunk_size = self.shaper.chunk_size
+        total_bucket = self.shaper.total_bucket
+        for chunk in self.chunks:
+            for start in range(0, len(chunk), chunk_size):
+                piece = chunk[start:start + chunk_size]
+                if self.bucket:
+                    self.bucket.consume(len(piece))
+                if total_bucket:
+                    total_bucket.consume(len(piece))
+                self.shaper._record(self.client_id, len(piece))
+                yield piece
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+        finally:
+            self.shaper._release(self.client_id)
+
+class EgressShaper:
+    """
+    以 token bucket 限制 /download_file 對每個客戶端及整體的傳輸速率
+    限速傳輸會佔用一個伺服器執行緒直到完成，因此同時也限制每個客戶端及整體的同時傳輸數
+    """
+
+    def __init__(self, per_client_rate, total_rate=0, per_client_transfers=1, max_transfers=2,
+                 chunk_size=EGRESS_CHUNK_SIZE, idle_ttl=CLIENT_IDLE_TTL):
+        self.per_client_rate = per_client_rate
+        self.per_client_transfers = per_client_transfers
+        self.max_transfers = max_transfers
+        self.chunk_size = chunk_size
+        self.idle_ttl = idle_ttl
+        self.total_bucket = TokenBucket(total_rate, max(total_rate, chunk_size)) if total_rate > 0 else None
+        self.active_transfers = 0
+        self.buckets = {}
+        self.usage = {}
+        self.last_active = {}
+        self.lock = threading.Lock()
+
+    def _evict_idle(self):
+        # 呼叫前必須持有 self.lock
+        now = time.monotonic()
+        for client_id, usage in list(self.usage.items()):
+            if not usage['active_transfers'] and now - self.last_active[client_id] > self.idle_ttl:
+                del self.usage[client_id]
+                del self.last_active[client_id]
+                self.buckets.pop(client_id, None)
+
+    def open(self, client_id, chunks):
+        """
+        包裝回應內容的迭代器，每送出一個區塊前先取得對應的 token
+        超過同時傳輸上限時回傳 None
+        """
+        with self.lock:
+            self._evict_idle()
+            self.last_active[client_id] = time.monotonic()
+            usage = self.usage.get(client_id)
+            if usage is None:
+                usage = self.usage[client_id] = {
+                    'bytes_sent': 0, 'active_transfers': 0, 'transfers': 0, 'rejected_transfers': 0
+                }
+                if self.per_client_rate > 0:
+                    self.buckets[client_id] = TokenBucket(
+                        self.per_client_rate, max(self.per_client_rate, self.chunk_size)
+                    )
+            if (usage['active_transfers'] >= self.per_client_transfers
+                    or self.active_transfers >= self.max_transfers):
+                usage['rejected_transfers'] += 1
+                return None
+            usage['active_transfers'] += 1
+            usage['transfers'] += 1
+            self.active_transfers += 1
+            return _ShapedTransfer(self, client_id, chunks, self.buckets.get(client_id))
+
+    def _record(self, client_id, amount):
+        with self.lock:
+            self.usage[client_id]['bytes_sent'] += amount
+
+    def _release(self, client_id):
+        with self.lock:
+            self.usage[client_id]['active_transfers'] -= 1
+            self.last_active[client_id] = time.monotonic()
+            self.active_transfers -= 1
+
+    def snapshot(self):
+        """回傳各客戶端的傳輸統計"""
+        with self.lock:
+            return {client_id: dict(usage) for client_id, usage in self.usage.items()}
+
+scheduler = FairShareScheduler(MAX_CONCURRENT_DOWNLOADS, PER_CLIENT_MAX_CONCURRENT, PER_CLIENT_MAX_QUEUED)
+egress_shaper = EgressShaper(EGRESS_RATE_PER_CLIENT, EGRESS_RATE_TOTAL, PER_CLIENT_MAX_TRANSFERS, MAX_CONCURRENT_TRANSFERS)
+
 class YouTubeDownloader:
     def __init__(self, temp_dir=None):
         self.temp_dir = temp_dir or tempfile.mkdtemp()
@@ -305,15 +637,28 @@ def download():
         
         # 生成下載ID
         download_id = str(uuid.uuid4())
+        client_id, weight = identify_client()
         
         # 在背景執行下載
         def background_download():
             downloader = YouTubeDownloader()
             downloader.download_video(url, quality, audio_only, download_id)
         
-        thread = threading.Thread(target=background_download)
-        thread.daemon = True
-        thread.start()
+        download_status[download_id] = {
+            'status': 'queued',
+            'progress': 0,
+            'title': '',
+            'error': None,
+            'file_path': None
+        }
+        # 交由排程器依客戶端公平分配下載名額
+        if not scheduler.submit(client_id, weight, download_id, background_download):
+            del download_status[download_id]
+            return jsonify({
+                'success': False,
+                'error': '排隊中的下載任務過多',
+                'message': f'每位使用者最多可排隊 {PER_CLIENT_MAX_QUEUED} 個下載任務，請等待目前的任務完成後再試'
+            }), 429
         
         return jsonify({
             'success': True,
@@ -328,7 +673,10 @@ def download():
 def get_status(download_id):
     """獲取下載狀態"""
     if download_id in download_status:
-        return jsonify(download_status[download_id])
+        status = dict(download_status[download_id])
+        if status['status'] == 'queued':
+            status['client_queue_position'] = scheduler.client_queue_position(download_id)
+        return jsonify(status)
     else:
         return jsonify({'status': 'not_found', 'error': '找不到下載任務'})
 
@@ -341,14 +689,49 @@ def download_file(download_id):
             file_path = status['file_path']
             if os.path.exists(file_path):
                 filename = os.path.basename(file_path)
-                return send_file(
+                response = send_file(
                     file_path,
                     as_attachment=True,
                     download_name=filename
                 )
+                # 依客戶端限制同時傳輸數與傳輸速率
+                client_id, _ = identify_client()
+                transfer = egress_shaper.open(client_id, response.response)
+                if transfer is None:
+                    response.close()
+                    return jsonify({'error': '同時進行的檔案傳輸過多，請等待目前的傳輸完成後再試'}), 429
+                response.response = transfer
+                return response
     
     return jsonify({'error': '檔案不存在或下載未完成'}), 404
 
+@app.route('/usage')
+def usage():
+    """各客戶端的下載排程與傳輸使用量，用於調整限制參數（需管理金鑰）"""
+    admin_key = request.headers.get('X-Admin-Key', '')
+    if not USAGE_ADMIN_KEY or not hmac.compare_digest(admin_key.encode('utf-8'), USAGE_ADMIN_KEY.encode('utf-8')):
+        return jsonify({'error': '未授權的存取'}), 403
+    
+    downloads = scheduler.snapshot()
+    egress = egress_shaper.snapshot()
+    return jsonify({
+        'limits': {
+            'max_concurrent_downloads': MAX_CONCURRENT_DOWNLOADS,
+            'per_client_max_concurrent': PER_CLIENT_MAX_CONCURRENT,
+            'per_client_max_queued': PER_CLIENT_MAX_QUEUED,
+            'egress_rate_per_client': EGRESS_RATE_PER_CLIENT,
+            'egress_rate_total': EGRESS_RATE_TOTAL,
+            'max_concurrent_transfers': MAX_CONCURRENT_TRANSFERS,
+            'per_client_max_transfers': PER_CLIENT_MAX_TRANSFERS
+        },
+        'clients': {
+            client_id: {
+                'downloads': downloads.get(client_id),
+                'egress': egress.get(client_id)
+            }
+            for client_id in sorted(set(downloads) | set(egress))
+        }
+    })
 
 
 @app.route('/health')
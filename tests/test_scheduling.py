@@ -0,0 +1,112 @@
+import threading
+import time
+
+import app
+from app import EgressShaper, FairShareScheduler, TokenBucket, parse_api_keys
+
+VIDEO_URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, '等待逾時'
+        time.sleep(0.01)
+
+
+def test_weighted_dispatch_order():
+    scheduler = FairShareScheduler(max_concurrent=1, per_client_concurrent=1, per_client_queued=10)
+    order = []
+    gate = threading.Event()
+
+    def job(tag):
+        return lambda: order.append(tag)
+
+    # 先佔住唯一的名額，讓所有工作都進入佇列後再開始分配
+    scheduler.submit('blocker', 1.0, 'blocker', gate.wait)
+    for i in range(4):
+        scheduler.submit('a', 1.0, f'a{i}', job('a'))
+    for i in range(6):
+        scheduler.submit('b', 3.0, f'b{i}', job('b'))
+    gate.set()
+
+    wait_until(lambda: len(order) == 10)
+    assert ''.join(order) == 'abbbabbbaa'
+
+
+def test_per_client_concurrency_cap():
+    scheduler = FairShareScheduler(max_concurrent=4, per_client_concurrent=1, per_client_queued=10)
+    gate = threading.Event()
+    for i in range(3):
+        scheduler.submit('a', 1.0, f'a{i}', gate.wait)
+    scheduler.submit('b', 1.0, 'b0', gate.wait)
+
+    snapshot = scheduler.snapshot()
+    assert snapshot['a']['active'] == 1
+    assert snapshot['a']['queued'] == 2
+    assert snapshot['b']['active'] == 1
+
+    gate.set()
+    wait_until(lambda: scheduler.snapshot()['a']['completed'] == 3)
+
+
+def test_client_queue_position():
+    scheduler = FairShareScheduler(max_concurrent=0, per_client_concurrent=1, per_client_queued=10)
+    scheduler.submit('a', 1.0, 'a0', lambda: None)
+    scheduler.submit('b', 1.0, 'b0', lambda: None)
+    scheduler.submit('a', 1.0, 'a1', lambda: None)
+
+    assert scheduler.client_queue_position('a0') == 1
+    assert scheduler.client_queue_position('a1') == 2
+    assert scheduler.client_queue_position('b0') == 1
+    assert scheduler.client_queue_position('missing') is None
+
+
+def test_queue_limit_returns_429(monkeypatch):
+    # 不分配任何名額，避免實際執行下載
+    monkeypatch.setattr(app, 'scheduler', FairShareScheduler(0, 1, 2))
+    monkeypatch.setattr(app, 'PER_CLIENT_MAX_QUEUED', 2)
+    client = app.app.test_client()
+
+    first = client.post('/download', json={'url': VIDEO_URL})
+    second = client.post('/download', json={'url': VIDEO_URL})
+    third = client.post('/download', json={'url': VIDEO_URL})
+
+    assert first.get_json()['success'] and second.get_json()['success']
+    assert third.status_code == 429
+    assert not third.get_json()['success']
+
+    status = client.get(f"/status/{second.get_json()['download_id']}").get_json()
+    assert status['status'] == 'queued'
+    assert status['client_queue_position'] == 2
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate=400000, capacity=40000)
+    bucket.consume(40000)
+
+    start = time.monotonic()
+    for _ in range(20):
+        bucket.consume(10000)
+    elapsed = time.monotonic() - start
+
+    # 200000 bytes 以 400000 bytes/秒傳輸約需 0.5 秒
+    assert 0.4 <= elapsed <= 0.8
+
+
+def test_egress_transfer_released_without_iteration():
+    shaper = EgressShaper(per_client_rate=0, per_client_transfers=1, max_transfers=2)
+    transfer = shaper.open('a', iter([b'data']))
+    assert shaper.open('a', iter([b'data'])) is None
+
+    # 未迭代就關閉（例如 HEAD 請求）也要釋放名額
+    transfer.close()
+    usage = shaper.snapshot()['a']
+    assert usage['active_transfers'] == 0
+    assert usage['transfers'] == 1
+    assert usage['rejected_transfers'] == 1
+    assert shaper.open('a', iter([b'data'])) is not None
+
+
+def test_parse_api_keys_rejects_non_finite_weights():
+    assert parse_api_keys('a=nan,b=inf,c=3,d') == {'a': 1.0, 'b': 1.0, 'c': 3.0, 'd': 1.0}